@@ -1,52 +1,147 @@
 import os
 import json
+import atexit
+import asyncio
+import datetime
+import functools
+from dataclasses import dataclass
+import queue
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.generativeai.types import generation_types
 from dotenv import load_dotenv
 from pypdf import PdfReader
 import gradio as gr
 
-# --- Load .env and optional Gemini key ---
+# --- Load .env once into an immutable config snapshot ---
+@dataclass(frozen=True, slots=True)
+class Config:
+    gemini_key: str | None
+    pushover_user: str | None
+    pushover_token: str | None
+
+    @property
+    def pushover_enabled(self):
+        return bool(self.pushover_user and self.pushover_token)
+
+
 load_dotenv(override=True)
-gemini_key = os.getenv("GOOGLE_API_KEY") 
-if gemini_key:
+CFG = Config(
+    gemini_key=os.environ.get("GOOGLE_API_KEY"),
+    pushover_user=os.environ.get("PUSHOVER_USER"),
+    pushover_token=os.environ.get("PUSHOVER_TOKEN"),
+)
+
+# --- Optional Gemini key (configured lazily, see warm_up) ---
+MODEL = None  # stays None until configured, or when no usable Gemini key is set
+if not CFG.gemini_key:
+    print("Warning: No Gemini API key found. Set GEMINI_API_KEY or GENAI_API_KEY if required.")
+
+
+def configure_gemini():
+    """Configures genai and builds the shared model; called once from warm_up()."""
+    global MODEL
+    if not CFG.gemini_key:
+        return
     try:
-        genai.configure(api_key=gemini_key)
+        genai.configure(api_key=CFG.gemini_key)
         print("Gemini API key configured from environment.")
+        # Build the model once and reuse it (and its transport) across requests
+        MODEL = genai.GenerativeModel("gemini-1.5-flash")
     except Exception as ex:
         print("Warning: couldn't configure genai with provided key:", ex)
-else:
-    print("Warning: No Gemini API key found. Set GEMINI_API_KEY or GENAI_API_KEY if required.")
 
 # --- Pushover Setup (optional) ---
-pushover_user = os.getenv("PUSHOVER_USER")
-pushover_token = os.getenv("PUSHOVER_TOKEN")
 pushover_url = "https://api.pushover.net/1/messages.json"
 
-if pushover_user:
-    print(f"Pushover user found and starts with {pushover_user[0]}")
+if CFG.pushover_user:
+    print(f"Pushover user found and starts with {CFG.pushover_user[0]}")
 else:
     print("Pushover user not found")
 
-if pushover_token:
-    print(f"Pushover token found and starts with {pushover_token[0]}")
+if CFG.pushover_token:
+    print(f"Pushover token found and starts with {CFG.pushover_token[0]}")
 else:
     print("Pushover token not found")
 
+# Reuse one keep-alive connection pool for all Pushover calls
+_pushover_session = requests.Session()
+_pushover_session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.2)),
+)
+atexit.register(_pushover_session.close)
 
-def push(message):
-    """Sends a message to Pushover (best-effort)."""
-    print(f"Push: {message}")
-    if not (pushover_user and pushover_token):
-        print("Pushover credentials missing — skipping HTTP push.")
-        return
-    payload = {"user": pushover_user, "token": pushover_token, "message": message}
+
+# Pushes are queued and sent by a background worker so callers never wait on HTTP
+PUSH_BATCH_SIZE = 10
+PUSH_FLUSH_INTERVAL = 5  # seconds to keep collecting a batch after its first message
+PUSH_SHUTDOWN_TIMEOUT = 10  # max seconds to wait for queued pushes at exit
+_push_q = queue.Queue()
+_FLUSH = object()  # queued at exit to end the current batching window early
+
+
+def _send_push(message):
+    payload = {"user": CFG.pushover_user, "token": CFG.pushover_token, "message": message}
     try:
-        requests.post(pushover_url, data=payload, timeout=5)
+        _pushover_session.post(pushover_url, data=payload, timeout=5)
     except Exception as e:
         print(f"Pushover request failed: {e}")
 
 
+def _push_worker():
+    """Collects up to PUSH_BATCH_SIZE messages or PUSH_FLUSH_INTERVAL seconds, then sends them."""
+    while True:
+        batch = [_push_q.get()]
+        deadline = time.monotonic() + PUSH_FLUSH_INTERVAL
+        while len(batch) < PUSH_BATCH_SIZE and batch[-1] is not _FLUSH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_push_q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Pushover takes one message per request; batching only coalesces the sends
+        for message in batch:
+            if message is not _FLUSH:
+                _send_push(message)
+            _push_q.task_done()
+
+
+def _drain_push_queue():
+    """Gives queued pushes up to PUSH_SHUTDOWN_TIMEOUT seconds to go out at exit."""
+    _push_q.put_nowait(_FLUSH)
+    waiter = threading.Thread(target=_push_q.join, daemon=True)
+    waiter.start()
+    waiter.join(PUSH_SHUTDOWN_TIMEOUT)
+    if waiter.is_alive():
+        print("Warning: gave up waiting for queued Pushover messages at exit.")
+
+
+# push() is chosen once here, so the disabled case has no per-call credential check
+if CFG.pushover_enabled:
+    threading.Thread(target=_push_worker, name="pushover-worker", daemon=True).start()
+    # Flush queued pushes on exit (runs before the session is closed: atexit is LIFO)
+    atexit.register(_drain_push_queue)
+
+    def push(message):
+        """Queues a message for Pushover (best-effort, non-blocking)."""
+        print(f"Push: {message}")
+        _push_q.put_nowait(message)
+else:
+    print("Pushover credentials missing — pushes will only be printed.")
+
+    def push(message):
+        """Pushover disabled: just log the message."""
+        print(f"Push: {message}")
+
+
 def record_user_details(email, name="Name not provided", notes="not provided"):
     """Records user's contact details via Pushover (manual call)."""
     push(f"Recording interest from {name} with email {email} and notes {notes}")
@@ -60,24 +155,47 @@ def record_unknown_question(question):
 
 
 # --- Document Loading ---
-try:
-    reader = PdfReader("me/DA_RESUME.pdf")
-    linkedin = "".join(page.extract_text() or "" for page in reader.pages)
-except FileNotFoundError:
-    linkedin = "Could not find LinkedIn file."
-    print("Warning: LinkedIn file 'me/DA_RESUME.pdf' not found. Using a placeholder.")
+RESUME_PATH = "me/DA_RESUME.pdf"
+SUMMARY_PATH = "me/summary.txt"
+# Assembled system prompt, keyed on the mtimes of its sources
+PROMPT_CACHE_PATH = "me/.sysprompt.cache"
+
+name = "N Harshit"
+
+
+def extract_pdf_text(reader):
+    """Extracts text from all pages with plain (non-layout) extraction."""
+    # Serial on purpose: pages share the reader's stream, so threads can
+    # interleave seeks and silently drop text
+    try:
+        return "".join(page.extract_text(extraction_mode="plain") or "" for page in reader.pages)
+    except TypeError:
+        # older pypdf without extraction_mode
+        return "".join(page.extract_text() or "" for page in reader.pages)
+
 
-try:
-    with open("me/summary.txt", "r", encoding="utf-8") as f:
-        summary = f.read()
-except FileNotFoundError:
-    summary = "Could not find summary file."
-    print("Warning: Summary file 'me/summary.txt' not found. Using a placeholder.")
+def load_documents():
+    """Reads the resume PDF and summary, using placeholders for missing files."""
+    try:
+        reader = PdfReader(RESUME_PATH)
+        linkedin = extract_pdf_text(reader)
+    except FileNotFoundError:
+        linkedin = "Could not find LinkedIn file."
+        print(f"Warning: LinkedIn file '{RESUME_PATH}' not found. Using a placeholder.")
+
+    try:
+        with open(SUMMARY_PATH, "r", encoding="utf-8") as f:
+            summary = f.read()
+    except FileNotFoundError:
+        summary = "Could not find summary file."
+        print(f"Warning: Summary file '{SUMMARY_PATH}' not found. Using a placeholder.")
+
+    return summary, linkedin
 
 
 # --- System prompt moved into first 'user' message (Gemini-friendly) ---
-name = "N Harshit"
-system_prompt = f"""[SYSTEM INSTRUCTION — for the assistant to follow]
+def build_system_prompt(summary, linkedin):
+    return f"""[SYSTEM INSTRUCTION — for the assistant to follow]
 You are acting as {name}. You are answering questions on {name}'s website,
 particularly questions related to {name}'s career, background, skills and experience.
 Represent {name} faithfully and professionally. If you don't know an answer, suggest the user share more details or provide contact information.
@@ -91,46 +209,191 @@ If the user asks to get in touch, ask for their email.
 """
 
 
+def system_prompt_cache_key():
+    """Cache key from source mtimes (app.py included for the template), or None if a file is missing."""
+    try:
+        return repr((
+            os.path.getmtime(RESUME_PATH),
+            os.path.getmtime(SUMMARY_PATH),
+            os.path.getmtime(__file__),
+        ))
+    except OSError:
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def load_system_prompt():
+    """Returns the system prompt from the on-disk cache, rebuilding it when stale."""
+    key = system_prompt_cache_key()
+    if key is not None:
+        try:
+            with open(PROMPT_CACHE_PATH, "r", encoding="utf-8") as f:
+                if f.readline().rstrip("\n") == key:
+                    return f.read()
+        except OSError:
+            pass
+
+    prompt = build_system_prompt(*load_documents())
+
+    # Never cache placeholder prompts built from missing files
+    if key is not None:
+        tmp_path = f"{PROMPT_CACHE_PATH}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(key + "\n" + prompt)
+            os.replace(tmp_path, PROMPT_CACHE_PATH)
+        except OSError as e:
+            print(f"Warning: couldn't write system prompt cache: {e}")
+    return prompt
+
+
+@functools.lru_cache(maxsize=1)
+def system_message():
+    """The system prompt as a Gemini 'user' turn, built once (the SDK copies it into protos)."""
+    return {"role": "user", "parts": [{"text": load_system_prompt()}]}
+
+
+# --- Upload the system prompt once as cached context (falls back to inline prompt) ---
+PROMPT_CACHE_TTL = datetime.timedelta(hours=1)
+USE_CACHED_PROMPT = False
+
+
+def refresh_prompt_cache():
+    """(Re)creates the CachedContent for the system prompt and rebinds MODEL to it."""
+    global MODEL, USE_CACHED_PROMPT
+    cache = genai.caching.CachedContent.create(
+        model="models/gemini-1.5-flash-001",
+        system_instruction=load_system_prompt(),
+        ttl=PROMPT_CACHE_TTL,
+    )
+    MODEL = genai.GenerativeModel.from_cached_content(cache)
+    USE_CACHED_PROMPT = True
+
+
+_prompt_cache_lock = threading.Lock()
+
+
+def prompt_cache_expired(exc):
+    """True for the errors Gemini returns once the cached context has expired or been deleted."""
+    return isinstance(exc, google_exceptions.NotFound) or (
+        isinstance(exc, google_exceptions.PermissionDenied) and "CachedContent" in str(exc)
+    )
+
+
+def refresh_expired_prompt_cache(stale_model):
+    """Recreates the expired cache once, unless another request already replaced stale_model."""
+    with _prompt_cache_lock:
+        if MODEL is stale_model:
+            refresh_prompt_cache()
+
+
+# --- Lazy startup: Gemini setup, documents and context cache run off the import path ---
+_warmup_lock = threading.Lock()
+_warmed_up = False
+
+
+def warm_up():
+    """Configures Gemini, loads the system prompt and uploads the context cache once (thread-safe)."""
+    global _warmed_up
+    with _warmup_lock:
+        if _warmed_up:
+            return
+        configure_gemini()
+        load_system_prompt()
+        if MODEL is not None:
+            try:
+                refresh_prompt_cache()
+                print("System prompt uploaded as cached context.")
+            except Exception as ex:
+                # e.g. prompt below the minimum cacheable size — keep sending it inline
+                print("Warning: context caching unavailable, sending system prompt inline:", ex)
+        _warmed_up = True
+
+
 # --- Robust content extractor for multiple SDK variants ---
-def extract_text_from_response(response_obj):
+def extract_text_from_response(response_obj, fallback=True):
     """
     Return best-effort text from genai.generate_content response object.
     Works across SDK variants that use .candidates[0].content.text or .parts.
+    With fallback=False (streamed chunks), return "" instead of a repr when
+    there is no text.
     """
+    _getattr = getattr  # local binding: this runs once per streamed chunk
     try:
-        if not getattr(response_obj, "candidates", None):
-            return str(response_obj)
+        if not _getattr(response_obj, "candidates", None):
+            return str(response_obj) if fallback else ""
 
         cand = response_obj.candidates[0]
-        content = getattr(cand, "content", None) or cand
+        content = _getattr(cand, "content", None) or cand
 
         # Many SDKs put full text at content.text
-        text = getattr(content, "text", None)
+        text = _getattr(content, "text", None)
         if text:
             return text
 
         # Some SDKs return parts with 'text' fields
-        parts = getattr(content, "parts", None)
+        parts = _getattr(content, "parts", None)
         if parts:
-            assembled = ""
+            parts_text = []
             for p in parts:
-                if isinstance(p, dict):
-                    t = p.get("text") or p.get("content") or ""
-                else:
-                    t = getattr(p, "text", None) or getattr(p, "content", None) or ""
+                try:
+                    t = p["text"]
+                except (TypeError, KeyError):
+                    t = None
+                if not t:
+                    if isinstance(p, dict):
+                        t = p.get("content")
+                    else:
+                        t = _getattr(p, "text", None) or _getattr(p, "content", None)
                 if t:
-                    assembled += t
-            if assembled:
-                return assembled
+                    parts_text.append(t)
+            if parts_text:
+                return "".join(parts_text)
 
         # Fallback
-        return str(cand)
+        return str(cand) if fallback else ""
 
     except Exception as e:
         return f"[Could not extract text from response: {e}]"
 
 
 # --- Normalize Gradio history (handles many shapes) ---
+def _s(x):
+    """Coerce to str, skipping the copy for values that already are (the common case)."""
+    return "" if x is None else x if type(x) is str else str(x)
+
+
+def _from_seq(item):
+    """lists/tuples: take first two elements"""
+    if len(item) >= 2:
+        return (_s(item[0]), _s(item[1]))
+    if len(item) == 1:
+        return (_s(item[0]), "")
+    return ("", "")
+
+
+def _from_dict(item):
+    """dicts: try common fields"""
+    # common Gradio shape: {'message': 'text', 'sender': 'user' } but not consistent
+    if "user" in item and "assistant" in item:
+        return (_s(item["user"]), _s(item["assistant"]))
+    if "sender" in item and "message" in item:
+        msg = _s(item["message"])
+        return (msg, "") if item["sender"] == "user" else ("", msg)
+    if "role" in item and "content" in item:
+        role = item["role"]
+        if role == "user":
+            return (_s(item["content"]), "")
+        if role in ("assistant", "model"):
+            return ("", _s(item["content"]))
+        return ("", "")
+    # fallback: take first two values in the dict
+    return _from_seq(list(item.values())[:2])
+
+
+_HISTORY_HANDLERS = {tuple: _from_seq, list: _from_seq, dict: _from_dict}
+
+
 def normalize_history(raw_history):
     """
     Normalize Gradio history entries into a list of (user_msg, model_msg) tuples.
@@ -141,85 +404,147 @@ def normalize_history(raw_history):
       - [{'role':..., 'content':...}, ...] (best-effort)
       - single strings
     """
+    handlers = _HISTORY_HANDLERS
     normalized = []
     for item in raw_history or []:
-        user_msg = ""
-        model_msg = ""
-
-        # lists/tuples: take first two elements
-        if isinstance(item, (list, tuple)):
-            if len(item) >= 2:
-                user_msg = "" if item[0] is None else str(item[0])
-                model_msg = "" if item[1] is None else str(item[1])
-            elif len(item) == 1:
-                user_msg = "" if item[0] is None else str(item[0])
-
-        # dicts: try common fields
-        elif isinstance(item, dict):
-            # common Gradio shape: {'message': 'text', 'sender': 'user' } but not consistent
-            if "user" in item and "assistant" in item:
-                user_msg = "" if item.get("user") is None else str(item.get("user"))
-                model_msg = "" if item.get("assistant") is None else str(item.get("assistant"))
-            elif "sender" in item and "message" in item:
-                if item.get("sender") == "user":
-                    user_msg = "" if item.get("message") is None else str(item.get("message"))
-                else:
-                    model_msg = "" if item.get("message") is None else str(item.get("message"))
-            elif "role" in item and "content" in item:
-                if item.get("role") == "user":
-                    user_msg = "" if item.get("content") is None else str(item.get("content"))
-                elif item.get("role") in ("assistant", "model"):
-                    model_msg = "" if item.get("content") is None else str(item.get("content"))
-            else:
-                # fallback: take first two values in the dict
-                vals = list(item.values())
-                if len(vals) >= 2:
-                    user_msg = "" if vals[0] is None else str(vals[0])
-                    model_msg = "" if vals[1] is None else str(vals[1])
-                elif len(vals) == 1:
-                    user_msg = "" if vals[0] is None else str(vals[0])
+        handler = handlers.get(type(item))
+        if handler is None:
+            # subclasses (e.g. OrderedDict) miss the exact-type lookup
+            if isinstance(item, (list, tuple)):
+                handler = _from_seq
+            elif isinstance(item, dict):
+                handler = _from_dict
+        # anything else: stringify to user message
+        normalized.append(handler(item) if handler else (str(item), ""))
+    return normalized
 
-        else:
-            # anything else: stringify to user message
-            user_msg = str(item)
 
-        normalized.append((user_msg, model_msg))
-    return normalized
+# --- Seed a Gemini chat session (first turn or session restore) ---
+# Only the most recent history entries are sent to Gemini; older turns are
+# dropped to bound per-request work and input tokens. Override to change.
+MAX_HISTORY_TURNS = 20
 
 
-# --- Chat function used by Gradio ---
-def chat(message, history):
+def build_seed_history(history):
     """
-    message: str
-    history: list (various shapes) from Gradio ChatInterface
+    Build the Gemini history used to start a ChatSession: the system prompt
+    (unless it lives in the cached context) followed by any prior turns.
     """
-    # Put the system instructions as the first user message so Gemini sees them
-    full_history = [{"role": "user", "parts": [{"text": system_prompt}]}]
+    # The cached model already carries the system instructions; otherwise put
+    # them in the first user message so Gemini sees them
+    if USE_CACHED_PROMPT:
+        seed = []
+    else:
+        seed = [system_message()]
 
     # Normalize and append prior conversation
     for user_msg, model_msg in normalize_history(history):
         if user_msg:
-            full_history.append({"role": "user", "parts": [{"text": user_msg}]})
+            seed.append({"role": "user", "parts": [{"text": user_msg}]})
         if model_msg:
-            full_history.append({"role": "model", "parts": [{"text": model_msg}]})
+            seed.append({"role": "model", "parts": [{"text": model_msg}]})
+    return seed
+
+
+def session_in_sync(session, synced_len, history):
+    """
+    True if the ChatSession still matches Gradio's history: its length is the one
+    recorded after our last reply, so nothing was retried, undone or edited since.
+    """
+    if len(history or []) != synced_len:
+        return False
+    try:
+        session.history
+    except (generation_types.BrokenResponseError, generation_types.IncompleteIterationError):
+        # a failed or interrupted turn poisons the session; rebuild it
+        return False
+    return True
+
+
+def trim_session(session):
+    """Drops the oldest turns so the session keeps at most MAX_HISTORY_TURNS after the seed."""
+    seed_len = 0 if USE_CACHED_PROMPT else 1
+    turns = session.history
+    excess = len(turns) - seed_len - MAX_HISTORY_TURNS
+    if excess > 0:
+        session.history = turns[:seed_len] + turns[seed_len + excess:]
+
+
+# --- Chat function used by Gradio ---
+async def chat(message, history, state=None):
+    """
+    message: str
+    history: list (various shapes) from Gradio ChatInterface
+    state: (ChatSession, Gradio history length it matches) kept in gr.State,
+           None on first turn or after a failed turn
 
-    # Add current user message
-    full_history.append({"role": "user", "parts": [{"text": message}]})
+    Async generator: yields the growing reply as Gemini streams it back.
+    """
+    # First request (if the launch-time warm-up hasn't finished): set up off the event loop
+    if not _warmed_up:
+        await asyncio.to_thread(warm_up)
 
-    # Create the model instance (no tools declared to avoid proto issues)
-    model = genai.GenerativeModel("gemini-1.5-flash")
+    if MODEL is None:
+        yield "Gemini is not configured. Please set GOOGLE_API_KEY and restart the app.", state
+        return
+
+    # Reuse the SDK's session history; only rebuild from Gradio's history on
+    # first turn or when they diverge (retry/undo/edit, restored page)
+    session, synced_len = state or (None, None)
+    if session is None or not session_in_sync(session, synced_len, history):
+        recent = (history or [])[-MAX_HISTORY_TURNS:]
+        session = MODEL.start_chat(history=build_seed_history(recent))
 
+    answer = ""
     try:
-        response = model.generate_content(full_history)
-        answer = extract_text_from_response(response)
+        try:
+            response = await session.send_message_async(message, stream=True)
+        except Exception as e:
+            if not (USE_CACHED_PROMPT and prompt_cache_expired(e)):
+                raise
+            # Cached context expired (TTL) — recreate it off the event loop and retry once
+            await asyncio.to_thread(refresh_expired_prompt_cache, session.model)
+            session = MODEL.start_chat(history=session.history)
+            response = await session.send_message_async(message, stream=True)
+
+        # Keep no session in gr.State while streaming, so a stopped or failed
+        # stream never leaves a half-finished session behind
+        async for chunk in response:
+            text = extract_text_from_response(chunk, fallback=False)
+            if text:
+                answer += text
+                yield answer, None
+
+        # The session only records the turn once the stream is fully consumed;
+        # this raises BrokenResponseError if it ended blocked (SAFETY, RECITATION, ...)
+        trim_session(session)
+        # Gradio appends this message and our reply to its history
+        state = (session, len(history or []) + 2)
         if not answer or answer.strip() == "":
-            return f"(no text extracted) {response}"
-        return answer
+            yield f"(no text extracted) {response}", state
+        else:
+            yield answer, state
 
     except Exception as e:
-        return f"An error occurred: {e}"
+        # Drop the session: the next turn rebuilds it from Gradio's history
+        yield f"{answer}\n\nAn error occurred: {e}" if answer else f"An error occurred: {e}", None
 
 
 # --- Launch Gradio Interface ---
 if __name__ == "__main__":
-    gr.ChatInterface(chat, type="messages").launch()
+    # Configure Gemini and parse documents while Gradio binds its port
+    # so the first request isn't penalized
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    # async handlers run on Gradio's event loop instead of one worker thread per request;
+    # the bounded queue caps in-flight calls and rejects bursts beyond max_size
+    with gr.Blocks() as demo:
+        # Created inside the Blocks so it is rendered and ChatInterface doesn't
+        # add an empty "Additional Inputs" accordion for it
+        session_state = gr.State(None)
+        gr.ChatInterface(
+            chat,
+            type="messages",
+            additional_inputs=[session_state],
+            additional_outputs=[session_state],
+        )
+    demo.queue(default_concurrency_limit=32, max_size=128).launch()